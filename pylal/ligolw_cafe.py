@@ -29,7 +29,12 @@ LIGO Light-Weight XML coincidence analysis front end.
 """
 
 
+from __future__ import print_function
+
+
+import bisect
 import math
+import operator
 import sys
 
 
@@ -55,30 +60,54 @@ __version__ = git_version.date
 #
 
 
-def load_cache(filename, verbose = False):
+def iter_cache(filename, verbose = False):
 	"""
-	Parse a LAL cache file named filename into a list of
-	glue.lal.CacheEntry objects.  If filename is None then input is
-	taken from stdin.
+	Parse a LAL cache file named filename, yielding a
+	glue.lal.CacheEntry object for each line.  If filename is None then
+	input is taken from stdin.  The file is read one line at a time, so
+	the whole cache need not be held in memory by single-pass
+	consumers like cache_to_seglistdict().
 	"""
 	if verbose:
-		print >>sys.stderr, "reading %s ..." % (filename or "stdin")
+		print("reading %s ..." % (filename or "stdin"), file = sys.stderr)
 	if filename is not None:
 		f = open(filename)
 	else:
 		f = sys.stdin
-	return [CacheEntry(line, coltype = lsctables.LIGOTimeGPS) for line in f]
+	try:
+		for line in f:
+			yield CacheEntry(line, coltype = lsctables.LIGOTimeGPS)
+	finally:
+		if f is not sys.stdin:
+			f.close()
+
+
+def load_cache(filename, verbose = False):
+	"""
+	Parse a LAL cache file named filename into a list of
+	glue.lal.CacheEntry objects.  If filename is None then input is
+	taken from stdin.  See also iter_cache().
+	"""
+	return list(iter_cache(filename, verbose = verbose))
 
 
 def cache_to_seglistdict(cache):
 	"""
-	Construct a coalesced segmentlistdict object from a list of
-	glue.lal.CacheEntry objects.
+	Construct a coalesced segmentlistdict object from an iterable of
+	glue.lal.CacheEntry objects, for example a list or the generator
+	returned by iter_cache().
 	"""
-	s = segments.segmentlistdict()
+	#
+	# collect the segments for each instrument and coalesce each list
+	# once at the end.  this is much faster than taking the union with
+	# each cache entry's segments in turn
+	#
+
+	segs = {}
 	for c in cache:
-		s |= c.segmentlistdict
-	return s
+		for instrument, seglist in cache_entry_segmentlistdict(c).items():
+			segs.setdefault(instrument, []).extend(seglist)
+	return segments.segmentlistdict((instrument, segments.segmentlist(seglist).coalesce()) for instrument, seglist in segs.items())
 
 
 #
@@ -90,6 +119,68 @@ def cache_to_seglistdict(cache):
 #
 
 
+def cache_entry_segmentlistdict(cache_entry):
+	"""
+	Return the .segmentlistdict attribute of a glue.lal.CacheEntry
+	object.  The CacheEntry class constructs a new segmentlistdict each
+	time the attribute is accessed;  this function constructs it once
+	and saves it on the cache entry for re-use.  The object returned
+	is shared, so callers must not modify it, and any offsets applied
+	to it must be cleared afterwards.
+	"""
+	try:
+		return cache_entry._ligolw_cafe_segmentlistdict
+	except AttributeError:
+		seglistdict = cache_entry._ligolw_cafe_segmentlistdict = cache_entry.segmentlistdict
+		return seglistdict
+
+
+def segmentlistdict_frames(seglistdict, offset_vector):
+	"""
+	Apply an offset vector to a segmentlist dictionary and express the
+	shifted segments in the unshifted time frame of each instrument in
+	the offset vector.  The return value is a list of (instrument,
+	segments) pairs, where segments is a list of the segments from all
+	of seglistdict's segment lists for the instruments named in the
+	offset vector, shifted by the amount needed to compare them to
+	instrument's unshifted segments.  Shifting a short segment list
+	into the time frame of a long one is much cheaper than shifting
+	both.
+	"""
+	segs = [(offset, seglistdict[instrument]) for instrument, offset in offset_vector.items() if instrument in seglistdict]
+	return [(instrument, [seg.shift(offset - origin) for offset, seglist in segs for seg in seglist]) for instrument, origin in offset_vector.items()]
+
+
+def cache_entry_shifted_segments(cache_entry, offset_vectors):
+	"""
+	Generator yielding the cache entry's segments shifted by each of
+	the offset vectors in turn.  The offset vectors are applied in
+	sequence as by repeated calls to .offsets.update() on the cache
+	entry's segmentlistdict, so an instrument that is not named in an
+	offset vector keeps the offset it was given by the previous one.
+	The cache entry's segmentlistdict is not modified.
+	"""
+	seglistdict = cache_entry_segmentlistdict(cache_entry)
+	offsets = dict.fromkeys(seglistdict, 0.0)
+	for offset_vector in offset_vectors:
+		offsets.update((instrument, offset) for instrument, offset in offset_vector.items() if instrument in offsets)
+		for instrument, seglist in seglistdict.items():
+			for seg in seglist:
+				yield seg.shift(offsets[instrument])
+
+
+def segmentlistdict_intersects_all(seglistdict, other):
+	"""
+	Equivalent to seglistdict.intersects_all(other), but tests each
+	segment of other against seglistdict by bisection.  The
+	segmentlist.intersects() method used by .intersects_all() walks
+	both lists, which is slow when, as when filtering a cache, the
+	lists in seglistdict are long and those in other are short.  The
+	segment lists in seglistdict must be coalesced.
+	"""
+	return bool(other) and all(key in seglistdict and any(seglistdict[key].intersects_segment(seg) for seg in seglist) for key, seglist in other.items())
+
+
 def segmentlistdict_normalize(seglistdict, origin):
 	"""
 	Convert the times in a segmentlist dictionary to floats relative to
@@ -97,9 +188,8 @@ def segmentlistdict_normalize(seglistdict, origin):
 	LIGOTimeGPS times to be manipulated more quickly without loss of
 	precision.  The modification is done in place.
 	"""
-	for seglist in seglistdict.itervalues():
-		for i, seg in enumerate(seglist):
-			seglist[i] = segments.segment(float(seg[0] - origin), float(seg[1] - origin))
+	for seglist in seglistdict.values():
+		seglist[:] = [segments.segment(float(seg[0] - origin), float(seg[1] - origin)) for seg in seglist]
 
 
 def get_coincident_segmentlistdict(seglistdict, offset_vectors):
@@ -171,9 +261,8 @@ def segmentlistdict_unnormalize(seglistdict, origin):
 	a segmentlist dictionary to absolute times.  The modification is
 	done in place.
 	"""
-	for seglist in seglistdict.itervalues():
-		for i, seg in enumerate(seglist):
-			seglist[i] = segments.segment(origin + seg[0], origin + seg[1])
+	for seglist in seglistdict.values():
+		seglist.shift(origin)
 
 
 #
@@ -199,16 +288,30 @@ class LALCacheBin(packing.Bin):
 		self.size = segments.segmentlistdict()
 		self.extent = None
 
+	def _extend(self, extent):
+		"""
+		Grow .extent to cover the segment extent, which may be
+		None.  Cheaper than re-running .extent_all() on .size.
+		"""
+		if self.extent is None:
+			self.extent = extent
+		elif extent is not None:
+			self.extent = segments.segment(min(self.extent[0], extent[0]), max(self.extent[1], extent[1]))
+
 	def add(self, cache_entry):
-		packing.Bin.add(self, cache_entry, cache_entry.segmentlistdict)
-		self.extent = self.size.extent_all()
+		size = cache_entry_segmentlistdict(cache_entry)
+		packing.Bin.add(self, cache_entry, size)
+		self._extend(size.extent_all())
 		return self
 
-	def __iadd__(self, *args):
-		packing.Bin.__iadd__(self, *args)
-		self.extent = self.size.extent_all()
+	def __iadd__(self, other):
+		packing.Bin.__iadd__(self, other)
+		self._extend(other.extent)
 		return self
 
+	def __lt__(self, other):
+		return self.extent < other.extent
+
 	def __cmp__(self, other):
 		return cmp(self.extent, other.extent)
 
@@ -216,6 +319,29 @@ class LALCacheBin(packing.Bin):
 		return "\n".join(map(str, self.objects))
 
 
+class BinExtentIndex(list):
+	"""
+	List of (end, id, bin) tuples kept in order of the end times of
+	the bins' extents.  Used by CafePacker to retrieve the bins whose
+	extents come within some distance of a new cache entry without
+	visiting every bin.  A bin's extent must not be modified while it
+	is in the index;  remove it with .discard(), modify it, and then
+	.add() it again.
+	"""
+	def add(self, bin):
+		bisect.insort(self, (bin.extent[1], id(bin), bin))
+
+	def discard(self, bin):
+		del self[bisect.bisect_left(self, (bin.extent[1], id(bin)))]
+
+	def find(self, seg):
+		"""
+		Return a list of the bins whose extents intersect the
+		segment seg.
+		"""
+		return [bin for end, dummy, bin in self[bisect.bisect_left(self, (seg[0],)):] if bin.extent[0] <= seg[1]]
+
+
 class CafePacker(packing.Packer):
 	"""
 	Packing algorithm implementing the ligolw_cafe file list packing
@@ -233,8 +359,15 @@ class CafePacker(packing.Packer):
 		# arithmetic operations performed while applying them
 		#
 
-		self.offset_vectors = list(offset_vectors)
-		self.offset_vectors.sort(key = lambda offset_vector: sorted(offset_vector.items()))
+		self.offset_vectors = sorted(offset_vectors, key = lambda offset_vector: tuple(sorted(offset_vector.items())))
+
+		#
+		# record the instruments named in each offset vector.  an
+		# offset vector cannot make a bin and cache entry
+		# coincident unless it names instruments from both
+		#
+
+		self.offset_vector_instruments = [frozenset(offset_vector) for offset_vector in self.offset_vectors]
 
 		#
 		# determine the largest gap that can conceivably be closed
@@ -246,6 +379,33 @@ class CafePacker(packing.Packer):
 		self.max_gap = max_offset - min_offset
 		assert self.max_gap >= 0
 
+		#
+		# is this a zero-lag only analysis?  if so .pack() and
+		# split_bins() can skip applying the offset vector
+		#
+
+		self.zero_lag_only = len(self.offset_vectors) == 1 and not any(self.offset_vectors[0].values())
+
+		#
+		# time-order the bins, and index them by extent so that the
+		# bins near a new cache entry can be found quickly.
+		# .pack() preserves the order
+		#
+
+		self.bins.sort()
+		self.extent_index = BinExtentIndex()
+		for bin in self.bins:
+			self.extent_index.add(bin)
+
+	def _bin_position(self, bin):
+		"""
+		Return the index of bin in the time-ordered .bins list.
+		"""
+		n = bisect.bisect_left(self.bins, bin)
+		while self.bins[n] is not bin:
+			n += 1
+		return n
+
 	def pack(self, cache_entry):
 		"""
 		Find all bins in which this glue.lal.CacheEntry instance
@@ -270,24 +430,49 @@ class CafePacker(packing.Packer):
 
 		#
 		# assemble a list of bins in which the cache entry belongs.
-		# iterate over existing bins backwards so that we record
-		# the indeces of matching bins in descending order.  bail
-		# out when we find a bin that precedes the new one
-		#
-
-		matching_bins = []
-		for n in xrange(len(self.bins) - 1, -1, -1):
-			bin = self.bins[n]
-			if bin.extent[1] < new.extent[0] - self.max_gap:
-				break
-			for offset_vector in self.offset_vectors:
-				new.size.offsets.update(offset_vector)
-				bin.size.offsets.update(offset_vector)
-				if bin.size.is_coincident(new.size, keys = offset_vector.keys()):
-					matching_bins.append(n)
-					break
-			bin.size.offsets.clear()
-		new.size.offsets.clear()
+		# only bins whose extents come within max_gap of the cache
+		# entry can possibly be coincident with it, so retrieve
+		# those from the extent index and test them.
+		#
+		# rather than applying each offset vector to both the bin
+		# and the cache entry, the cache entry's segments are
+		# shifted into the time frame of each of the bin's
+		# instruments.  this is done at most once for each offset
+		# vector, and the bins' segment lists are not modified.
+		#
+		# offset vectors that do not name any of the cache entry's
+		# instruments are skipped, as are those that do not name
+		# any of a bin's instruments.
+		#
+
+		new_instruments = frozenset(new.size)
+		candidates = self.extent_index.find(new.extent.protract(self.max_gap))
+
+		if self.zero_lag_only:
+			#
+			# fast path for zero-lag only analyses:  nothing is
+			# shifted, so the cache entry's segments are tested
+			# directly against the bins' segment lists
+			#
+
+			instruments = self.offset_vector_instruments[0]
+			new_segs = [seg for instrument in instruments & new_instruments for seg in new.size[instrument]]
+			matching_bins = [bin for bin in candidates if any(bin.size[instrument].intersects_segment(seg) for instrument in instruments.intersection(bin.size) for seg in new_segs)]
+		else:
+			offset_vectors = [(n, offset_vector, instruments) for n, (offset_vector, instruments) in enumerate(zip(self.offset_vectors, self.offset_vector_instruments)) if instruments & new_instruments]
+			new_frames = [None] * len(self.offset_vectors)
+
+			matching_bins = []
+			for bin in candidates:
+				bin_instruments = frozenset(bin.size)
+				for n, offset_vector, instruments in offset_vectors:
+					if not instruments & bin_instruments:
+						continue
+					if new_frames[n] is None:
+						new_frames[n] = segmentlistdict_frames(new.size, offset_vector)
+					if any(bin.size[instrument].intersects_segment(seg) for instrument, segs in new_frames[n] if instrument in bin.size for seg in segs):
+						matching_bins.append(bin)
+						break
 
 		#
 		# add new cache entry to bins
@@ -298,28 +483,37 @@ class CafePacker(packing.Packer):
 			# no existing bins match, add a new one
 			#
 
-			self.bins.append(new)
+			dest = new
 		else:
 			#
 			# put cache entry into first bin that was found to
 			# match.  if cache entry belongs in more than one
-			# bin, merge them.  note that the matching bin
-			# indexes are given in descending order so poping
-			# the bins as we go does not affect the indexes of
-			# the remaining, matching, bins.
+			# bin, merge them.  the matching bins are popped in
+			# descending order of their indexes so that
+			# removing them as we go does not affect the
+			# indexes of the remaining, matching, bins.  the
+			# extents of the bins are about to change so they
+			# must be removed from the extent index first.
 			#
 
-			dest = self.bins[matching_bins.pop(-1)]
-			dest += new
+			matching_bins = sorted((self._bin_position(bin) for bin in matching_bins), reverse = True)
 			for n in matching_bins:
+				self.extent_index.discard(self.bins[n])
+			dest = self.bins[matching_bins[-1]]
+			dest += new
+			for n in matching_bins[:-1]:
 				dest += self.bins.pop(n)
+			del self.bins[matching_bins[-1]]
 
 		#
-		# time-order the bins so the bail-out above works next time
+		# the bins other than dest are still in time order.  insert
+		# dest at its place among them so that the positions of
+		# bins to be merged can be found by bisection the next time
 		# this method is called
 		#
 
-		self.bins.sort()
+		bisect.insort(self.bins, dest)
+		self.extent_index.add(dest)
 
 
 def split_bins(cafepacker, extentlimit, verbose = False):
@@ -328,6 +522,16 @@ def split_bins(cafepacker, extentlimit, verbose = False):
 	than extentlimit.
 	"""
 
+	#
+	# how to compute the times spanned by a cache entry under the
+	# offset vectors.  in a zero-lag only analysis nothing is shifted
+	#
+
+	if cafepacker.zero_lag_only:
+		shifted_segments = lambda cache_entry: (seg for seglist in cache_entry_segmentlistdict(cache_entry).values() for seg in seglist)
+	else:
+		shifted_segments = lambda cache_entry: cache_entry_shifted_segments(cache_entry, cafepacker.offset_vectors)
+
 	#
 	# loop over all bins in cafepacker.bins.  loop is backwards because
 	# list grows in size as bins are split
@@ -356,9 +560,18 @@ def split_bins(cafepacker, extentlimit, verbose = False):
 
 		extents = [origbin.extent[0]] + [lsctables.LIGOTimeGPS(origbin.extent[0] + i * float(abs(origbin.extent)) / n) for i in range(1, n)] + [origbin.extent[1]]
 		if verbose:
-			print >>sys.stderr, "\tsplitting cache spanning %s at %s" % (str(origbin.extent), ", ".join(str(extent) for extent in extents[1:-1]))
+			print("\tsplitting cache spanning %s at %s" % (str(origbin.extent), ", ".join(str(extent) for extent in extents[1:-1])), file = sys.stderr)
 		extents = [segments.segment(*bounds) for bounds in zip(extents[:-1], extents[1:])]
 
+		#
+		# time-order the contents of origbin so that the cache
+		# entries near each new bin can be found by bisection
+		#
+
+		objects = sorted(origbin.objects, key = operator.attrgetter("segment"))
+		starts = [cache_entry.segment[0] for cache_entry in objects]
+		max_duration = max(abs(cache_entry.segment) for cache_entry in objects)
+
 		#
 		# build new bins, pack objects from origbin into new bins
 		#
@@ -372,11 +585,14 @@ def split_bins(cafepacker, extentlimit, verbose = False):
 			newbins.append(LALCacheBin())
 
 			#
-			# test each cache entry in original bin
+			# test each cache entry in original bin that might
+			# be within max_gap of the new bin
 			#
 
 			extent_plus_max_gap = extent.protract(cafepacker.max_gap)
-			for cache_entry in origbin.objects:
+			lo = bisect.bisect_left(starts, extent_plus_max_gap[0] - max_duration)
+			hi = bisect.bisect_right(starts, extent_plus_max_gap[1])
+			for cache_entry in objects[lo:hi]:
 				#
 				# quick check of gap
 				#
@@ -385,25 +601,16 @@ def split_bins(cafepacker, extentlimit, verbose = False):
 					continue
 
 				#
-				# apply each offset vector
+				# apply each offset vector and test against
+				# bin
 				#
 
-				cache_entry_segs = cache_entry.segmentlistdict
-				for offset_vector in cafepacker.offset_vectors:
-					cache_entry_segs.offsets.update(offset_vector)
-
+				if any(seg.intersects(extent) for seg in shifted_segments(cache_entry)):
 					#
-					# test against bin
+					# object is coicident with bin
 					#
 
-					if cache_entry_segs.intersects_segment(extent):
-						#
-						# object is coicident with
-						# bin
-						#
-
-						newbins[-1].add(cache_entry)
-						break
+					newbins[-1].add(cache_entry)
 
 			#
 			# override the bin's extent
@@ -431,25 +638,42 @@ def split_bins(cafepacker, extentlimit, verbose = False):
 #
 
 
-def write_caches(base, bins, instruments, verbose = False):
-	filenames = []
-	if len(bins):
-		pattern = "%%s%%0%dd.cache" % int(math.log10(len(bins)) + 1)
-	for n, bin in enumerate(bins):
-		filename = pattern % (base, n)
-		filenames.append(filename)
+def bin_instruments(bins):
+	"""
+	Return a dictionary mapping the id() of each glue.lal.CacheEntry
+	object in the bins to a frozenset of the instruments for which it
+	provides data.  Used by write_caches() to select the cache entries
+	to write without recomputing this for every output cache.
+	"""
+	return dict((id(cacheentry), frozenset(cache_entry_segmentlistdict(cacheentry))) for bin in bins for cacheentry in bin.objects)
+
+
+def write_caches(base, bins, instruments, verbose = False, entry_instruments = None):
+	"""
+	Write the contents of each bin to a LAL cache file whose name is
+	constructed from base and the bin's index.  Only cache entries
+	providing data for at least one of the instruments in instruments
+	are written.  entry_instruments is the dictionary returned by
+	bin_instruments(), and is computed if not supplied.  Returns the
+	list of file names.
+	"""
+	if entry_instruments is None:
+		entry_instruments = bin_instruments(bins)
+	width = len(str(len(bins)))
+	filenames = ["%s%0*d.cache" % (base, width, n) for n in range(len(bins))]
+	for filename, bin in zip(filenames, bins):
 		if verbose:
-			print >>sys.stderr, "writing %s ..." % filename
+			print("writing %s ..." % filename, file = sys.stderr)
 		f = open(filename, "w")
-		for cacheentry in bin.objects:
-			if instruments & set(cacheentry.segmentlistdict.keys()):
-				print >>f, str(cacheentry)
+		f.write("".join("%s\n" % str(cacheentry) for cacheentry in bin.objects if not entry_instruments[id(cacheentry)].isdisjoint(instruments)))
+		f.close()
 	return filenames
 
 
 def write_single_instrument_caches(base, bins, instruments, verbose = False):
+	entry_instruments = bin_instruments(bins)
 	for instrument in instruments:
-		write_caches("%s%s_" % (base, instrument), bins, [instrument], verbose)
+		write_caches("%s%s_" % (base, instrument), bins, [instrument], verbose, entry_instruments = entry_instruments)
 
 
 #
@@ -484,7 +708,7 @@ def ligolw_cafe(cache, offset_vectors, verbose = False, extentlimit = None):
 	#
 
 	if verbose:
-		print >>sys.stderr, "computing segment list ..."
+		print("computing segment list ...", file = sys.stderr)
 	seglists = cache_to_seglistdict(cache)
 
 	#
@@ -504,20 +728,15 @@ def ligolw_cafe(cache, offset_vectors, verbose = False, extentlimit = None):
 	# times spanned by the input files that are coincident under at
 	# least one time slide, a file participates in a multi-instrument
 	# coincidence if and only if it intersects these times.
-	#
-
-	if verbose:
-		print >>sys.stderr, "filtering input cache ..."
-	cache = [c for c in cache if seglists.intersects_all(c.segmentlistdict)]
-
 	#
 	# Optimization: adding files to bins in time order keeps the number
-	# of bins from growing larger than needed.
+	# of bins from growing larger than needed.  The files are sorted as
+	# they are filtered.
 	#
 
 	if verbose:
-		print >>sys.stderr, "sorting input cache ..."
-	cache.sort(key = lambda x: x.segment)
+		print("filtering and sorting input cache ...", file = sys.stderr)
+	cache = sorted((c for c in cache if segmentlistdict_intersects_all(seglists, cache_entry_segmentlistdict(c))), key = operator.attrgetter("segment"))
 
 	#
 	# Pack cache entries into output caches.  Having reduced the file
@@ -529,13 +748,13 @@ def ligolw_cafe(cache, offset_vectors, verbose = False, extentlimit = None):
 	packer = CafePacker(outputcaches)
 	packer.set_offset_vectors(offset_vectors)
 	if verbose:
-		print >>sys.stderr, "packing files (considering %s offset vectors) ..." % len(offset_vectors)
+		print("packing files (considering %s offset vectors) ..." % len(offset_vectors), file = sys.stderr)
 	for n, cacheentry in enumerate(cache):
 		if verbose and not n % 13:
-			print >>sys.stderr, "\t%.1f%%\t(%d files, %d caches)\r" % (100.0 * n / len(cache), n + 1, len(outputcaches)),
+			print("\t%.1f%%\t(%d files, %d caches)\r" % (100.0 * n / len(cache), n + 1, len(outputcaches)), end = "", file = sys.stderr)
 		packer.pack(cacheentry)
 	if verbose:
-		print >>sys.stderr, "\t100.0%%\t(%d files, %d caches)" % (len(cache), len(outputcaches))
+		print("\t100.0%%\t(%d files, %d caches)" % (len(cache), len(outputcaches)), file = sys.stderr)
 
 	#
 	# Split caches with extent more than extentlimit
@@ -543,19 +762,21 @@ def ligolw_cafe(cache, offset_vectors, verbose = False, extentlimit = None):
 
 	if extentlimit is not None:
 		if verbose:
-			print >>sys.stderr, "splitting caches with extent greater than %g s ..." % extentlimit
+			print("splitting caches with extent greater than %g s ..." % extentlimit, file = sys.stderr)
 		split_bins(packer, extentlimit, verbose = verbose)
 		if verbose:
-			print >>sys.stderr, "\t\t(%d files, %d caches)" % (len(cache), len(outputcaches))
+			print("\t\t(%d files, %d caches)" % (len(cache), len(outputcaches)), file = sys.stderr)
 
 	#
-	# Sort output caches
+	# Sort output caches.  The key gives the same order as
+	# CacheEntry.__cmp__() but is evaluated only once per entry
 	#
 
 	if verbose:
-		print >>sys.stderr, "sorting output caches ..."
+		print("sorting output caches ...", file = sys.stderr)
+	key = operator.attrgetter("observatory", "description", "segment", "url")
 	for cache in outputcaches:
-		cache.objects.sort()
+		cache.objects.sort(key = key)
 
 	#
 	# Done.